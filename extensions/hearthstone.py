@@ -1,13 +1,113 @@
+import aiohttp
 import asyncio
 import checks
 from discord.ext import commands
-import copy
-from datetime import datetime
-import json
+from email.utils import formatdate
 import os
-import requests
+import re
 import sys
 
+_QUERY_RE = re.compile(r'\[([^\[\]]+)\]')
+_SPELL_POWER_RE = re.compile(r'\$(\d)')
+_HTML_TAG_RES = {tag: re.compile(r'<(/?){}>'.format(tag)) for tag in ('b', 'i')}
+
+#orjson is optional, the stdlib json module is used when it isn't installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    import json
+    def _json_loads(data):
+        return json.loads(data.decode('utf8'))
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf8')
+
+try:
+    import stringzilla
+except ImportError:
+    stringzilla = None
+#newer StringZilla releases no longer provide edit_distance
+_edit_distance = getattr(stringzilla, 'edit_distance', None)
+
+class CardType():
+    MINION = "MINION"
+    SPELL = "SPELL"
+    WEAPON = "WEAPON"
+
+class CardSet():
+    BASIC = "CORE"
+    BRM = "BRM"
+    CLASSIC = "EXPERT1"
+    CHEAT = "CHEAT"
+    CREDITS = "CREDITS"
+    GVG = "GVG"
+    HERO_SKINS = "HERO_SKINS"
+    KARA = "KARA"
+    LOE = "LOE"
+    MISSIONS = "MISSIONS"
+    NAXX = "NAXX"
+    NONE = "NONE"
+    PROMO = "PROMO"
+    REWARD = "REWARD"
+    TAVERNBRAWL = "TB"
+    TGT = "TGT"
+
+_ALLOWED_TYPES = frozenset({CardType.MINION, CardType.SPELL, CardType.WEAPON})
+_DEFAULT_UNWANTED_SETS = frozenset({CardSet.CHEAT, CardSet.CREDITS, CardSet.HERO_SKINS,
+                                    CardSet.MISSIONS, CardSet.NONE, CardSet.TAVERNBRAWL})
+
+def _levenshtein_distance(s1, s2, max_dist):
+    """Returns the Levenshtein distance between two strings.
+    Returns max_dist + 1 as soon as the distance is known to be larger than max_dist.
+    Uses StringZilla's compiled edit distance when available, pure Python otherwise."""
+
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+
+    # len(s1) >= len(s2)
+    if len(s1) - len(s2) > max_dist:
+        return max_dist + 1
+    if len(s2) == 0:
+        return len(s1)
+
+    if _edit_distance is not None:
+        b1 = s1.encode()
+        b2 = s2.encode()
+        #byte distance only equals character distance for ASCII strings
+        if len(b1) == len(s1) and len(b2) == len(s2):
+            return _edit_distance(b1, b2, bound=max_dist + 1)
+
+    #only the diagonal band |i - j| <= max_dist can hold a path of cost <= max_dist,
+    #cells outside of it are treated as out of range
+    out_of_range = max_dist + 1
+    len_s2 = len(s2)
+    previous_row = [j if j <= max_dist else out_of_range for j in range(len_s2 + 1)]
+    current_row = [out_of_range] * (len_s2 + 1)
+    for i, c1 in enumerate(s1, 1):
+        low = max(1, i - max_dist)
+        high = min(len_s2, i + max_dist)
+
+        current_row[0] = i if i <= max_dist else out_of_range
+        current_row[low - 1] = current_row[0] if low == 1 else out_of_range
+        row_min = current_row[low - 1]
+        for j in range(low, high + 1):
+            insertions = previous_row[j] + 1
+            deletions = current_row[j - 1] + 1
+            substitutions = previous_row[j - 1] + (c1 != s2[j - 1])
+            current_row[j] = min(insertions, deletions, substitutions)
+            if current_row[j] < row_min:
+                row_min = current_row[j]
+        if high < len_s2:
+            current_row[high + 1] = out_of_range
+
+        #every cell of the row is over the threshold so the final distance is too
+        if row_min > max_dist:
+            return out_of_range
+        previous_row, current_row = current_row, previous_row
+
+    return min(previous_row[-1], out_of_range)
+
 class Hearthstone():
     """Card searches through square brackets disabled by default"""
 
@@ -20,35 +120,35 @@ class Hearthstone():
         self.bot = bot
         self.lang = lang
         self.min_match = min_match
-        self.cards = self._set_cards()
-        self._clean_cards_dict(self.cards)
+        self.cards = []
+        #loaded here so a broken local cards.json fails the extension load
+        if os.path.exists(self.cards_path):
+            self.cards = self._load_cards()
         self.whitelist = self._set_whitelist()
 
         self.whitelist_lock = asyncio.Lock()
 
+        #cards.json is refreshed in the background so startup doesn't block the event loop
+        bot.loop.create_task(self._update_cards())
+
     def _set_whitelist(self):
-        """Retrieves whitelist from a JSON file and return it. Empty list if file is not found."""
+        """Retrieves whitelist from a JSON file and return it as a set. Empty set if file is not found."""
 
-        whitelist = []
+        whitelist = set()
         try:
-            file = open(self.whitelist_path, 'r', encoding='utf8')
-            try:
-                whitelist = json.loads(file.read())
-            except ValueError:
-                pass
+            with open(self.whitelist_path, 'rb') as file:
+                whitelist = set(_json_loads(file.read()))
         except FileNotFoundError:
-            file = open(self.whitelist_path, 'w+', encoding='utf8')
-        finally:
-            file.close()
             self._save_whitelist(whitelist)
+        except ValueError:
+            pass
         return whitelist
 
     def _save_whitelist(self, whitelist):
-        """Saves a whitelist to whitelist.json"""
+        """Saves a whitelist to whitelist.json as a JSON list"""
 
-        file = open(self.whitelist_path, 'w', encoding='utf8')
-        json.dump(whitelist, file)
-        file.close()
+        with open(self.whitelist_path, 'wb') as file:
+            file.write(_json_dumps(list(whitelist)))
 
     @commands.command(name="hs", pass_context = True)
     @checks.is_not_pvt_chan()
@@ -67,7 +167,7 @@ class Hearthstone():
             id = ctx.message.channel.id
             if enabled:
                 if id not in self.whitelist:
-                    self.whitelist.append(id)
+                    self.whitelist.add(id)
                     self._save_whitelist(self.whitelist)
                     await self.bot.say("Hearthstone Card Lookup Detection Enabled")
                 else:
@@ -80,84 +180,78 @@ class Hearthstone():
                 else:
                     await self.bot.say("Already Disabled")
 
-    def _get_server_mod_time(self):
-        """Retrieves last modified time from hsjson's server in seconds since the Epoch"""
+    async def _download_card_json(self):
+        """Streams cards.json from hsjson to file if the server's copy is newer than the local file.
+        Returns True if a new cards.json was downloaded"""
 
-        time = 0
-        try:
-            response = requests.get(self.cards_url)
-            response.raise_for_status()
-            time = response.headers['Last-Modified']
-            time = datetime.strptime(time, "%a, %d %b %Y %X %Z").timestamp()
-        except Exception as e:
-            print("Hearthstone: Error getting server cards.json last modified time")
-        return time
-
-    def _download_card_json(self):
-        """Retrieves cards.json from hsjson and returns the dictionary"""
+        headers = {}
+        if os.path.exists(self.cards_path):
+            #the server answers 304 Not Modified when the local file is up to date
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(self.cards_path), usegmt=True)
 
-        cards = None
+        #downloads to a temporary file first so a failed download can't leave a truncated cards.json
+        temp_path = self.cards_path + ".tmp"
         try:
-            response = requests.get(self.cards_url)
-            response.raise_for_status()
-            cards = response.json()
+            with aiohttp.ClientSession() as session:
+                async with session.get(self.cards_url, headers=headers) as response:
+                    if response.status == 304:
+                        return False
+                    if response.status != 200:
+                        print("Hearthstone: Error downloading cards.json, server returned status {}".format(response.status))
+                        return False
+                    with open(temp_path, 'wb') as file:
+                        while True:
+                            chunk = await response.content.read(64 * 1024)
+                            if not chunk:
+                                break
+                            #disk writes run in the executor so they don't stall the event loop
+                            await self.bot.loop.run_in_executor(None, file.write, chunk)
+            os.replace(temp_path, self.cards_path)
         except Exception as e:
             print(e)
-        return cards
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
 
     def _load_card_json(self):
         """Loads cards.json from file and returns the dictionary"""
 
-        file = open(self.cards_path, 'r', encoding='utf8')
-        cards = json.loads(file.read())
-        file.close()
-        return cards
+        with open(self.cards_path, 'rb') as file:
+            return _json_loads(file.read())
 
-    def _save_card_json(self, cards):
-        """Saves a cards dictionary to cards.json file"""
+    def _load_cards(self):
+        """Loads cards.json from file, cleans it and returns the new card list"""
 
-        file = open(self.cards_path, 'w', encoding='utf8')
-        json.dump(cards, file)
-        file.close()
+        cards = self._load_card_json()
+        self._clean_cards_dict(cards)
+        return cards
 
-    def _set_cards(self):
-        """Retrieves the most up to date cards.json file and returns the dictionary.
-        cards.json will be downloaded if there is no local file or it is out of date."""
+    async def _update_cards(self):
+        """Downloads cards.json if there is no local file or it is out of date and reloads the card list.
+        Errors are printed since this runs as a background task."""
 
-        local_time = 0
         try:
-            local_time = os.stat(self.cards_path).st_mtime
+            #the card list loaded in __init__ is already current unless a new file was downloaded
+            if await self._download_card_json() or not self.cards:
+                #parsing and cleaning thousands of cards runs in the executor so the bot stays responsive,
+                #the finished list is only swapped in back on the event loop
+                self.cards = await self.bot.loop.run_in_executor(None, self._load_cards)
         except Exception as e:
+            print("Hearthstone: Error updating cards")
             print(e)
 
-        server_time = self._get_server_mod_time()
-
-        if server_time > local_time:
-            cards = self._download_card_json()
-            self._save_card_json(cards)
-        else:
-            cards = self._load_card_json()
-
-        return cards
-
     def _clean_cards_dict(self, cards, unwanted_sets=None):
         """Formats cards dict to remove unwanted cards and reformat text"""
 
-        cards_copy = copy.deepcopy(cards)
         if unwanted_sets is None:
-            unwanted_sets = [CardSet.CHEAT, CardSet.CREDITS, CardSet.HERO_SKINS, 
-            CardSet.MISSIONS, CardSet.NONE, CardSet.TAVERNBRAWL]
-        for card in cards_copy:
-            if not 'type' in card: 
-                cards.remove(card)
-                continue
-
-            type = card['type'] 
-            set = card['set']
-            if set in unwanted_sets:
-                cards.remove(card)
-            elif type not in [CardType.MINION, CardType.SPELL, CardType.WEAPON]:
-                cards.remove(card)
+            unwanted_sets = _DEFAULT_UNWANTED_SETS
+        else:
+            unwanted_sets = frozenset(unwanted_sets)
+
+        #filters in place since callers keep a reference to the list
+        cards[:] = [card for card in cards
+                    if card.get('type') in _ALLOWED_TYPES and card.get('set') not in unwanted_sets]
         for card in cards:
             self._format_card(card)
 
@@ -165,35 +259,23 @@ class Hearthstone():
         """Takes a card dict and format its fields"""
 
         def replace_html_tag(text, tag, replace):
-            start_tag = "<{}>".format(tag)
-            end_tag = "</{}>".format(tag)
-
-            #handle nested HTML tags
-            index = text.find(start_tag)
-            while index != -1:
-                count = 1
-
-                while True:
-                    sub_index = text.find(start_tag*(count+1))
-                    if sub_index == -1:
-                        break
-                    count += 1
+            #handle nested HTML tags, only the outermost pair of tags is replaced
+            depth = 0
 
-                text = text.replace(start_tag*count, replace, 1)
-                text = text.replace(end_tag, "", count-1)
-                text = text.replace(end_tag, replace, 1)
+            def replace_tag(match):
+                nonlocal depth
+                if match.group(1):
+                    if depth == 0:
+                        return match.group(0)
+                    depth -= 1
+                    return replace if depth == 0 else ""
+                depth += 1
+                return replace if depth == 1 else ""
 
-                index = text.find(start_tag)
-
-            return text
+            return _HTML_TAG_RES[tag].sub(replace_tag, text)
 
         def replace_spell_power_char(text):
-            char = '$'
-            pos = text.find(char)
-            while pos != -1:
-                text = text[:pos] + "\\*" + text[pos+1] + "\\*" + text[pos+2:] #backslashes escapes markdown italics
-                pos = text.find(char)
-            return text
+            return _SPELL_POWER_RE.sub(r'\\*\1\\*', text) #backslashes escapes markdown italics
 
         if 'rarity' in card:
             if card['rarity'] == "FREE": card['rarity'] = "BASIC"
@@ -234,70 +316,77 @@ class Hearthstone():
             elif cset == CardSet.CLASSIC:
                 card['set'] = 'Classic'
 
+        #name fields used by _find_card, these don't change after formatting
+        card['_name_lower'] = card['name'].lower()
+        card['_name_words'] = tuple(card['_name_lower'].split(' '))
+        card['_name_nospace_len'] = len(card['_name_lower'].replace(' ', ''))
+        card['_name_longest_word_len'] = max(len(word) for word in card['_name_words'])
+
     async def _find_card(self, query, min_match):
         """Retrieves the best matching card. Returns None if no card found"""
 
-        def calc_levenshtein_distance(s1, s2):
-            if len(s1) < len(s2):
-                return calc_levenshtein_distance(s2, s1)
-
-            # len(s1) >= len(s2)
-            if len(s2) == 0:
-                return len(s1)
-
-            previous_row = range(len(s2) + 1)
-            for i, c1 in enumerate(s1):
-                current_row = [i + 1]
-                for j, c2 in enumerate(s2):
-                    insertions = previous_row[j + 1] + 1 # j+1 instead of j since previous_row and current_row are one character longer
-                    deletions = current_row[j] + 1       # than s2
-                    substitutions = previous_row[j] + (c1 != c2)
-                    current_row.append(min(insertions, deletions, substitutions))
-                previous_row = current_row
-            
-            return previous_row[-1]
-
         results = []
         query = query.strip(' ').lower()
         if len(query) < 1:
             return
-        for card in self.cards:
-            name = card['name'].lower()
+        #duplicate query words are only scored once. dict.fromkeys iterates in the same order as the dict
+        #the original search used, so float sums and the ties between them are unchanged
+        search_words = list(dict.fromkeys(query.split(' ')))
+        query_nospace_len = len(query.replace(" ", ""))
+        percent_string_matches = [len(search_word) / query_nospace_len for search_word in search_words]
+        #remaining_string_matches[i] is the query share of search_words[i:]
+        remaining_string_matches = [sum(percent_string_matches[i:]) for i in range(len(search_words))]
+
+        #card names share words, so distances are memoized for the length of this lookup only
+        distances = {}
+
+        def word_match(search_word, card_word, best_match):
+            """Returns the match ratio of two words, None if it can't be higher than best_match"""
+
+            max_len = max(len(search_word), len(card_word))
+            #a distance over max_dist can't beat best_match, the extra 1 absorbs float rounding
+            max_dist = min(int((1 - best_match) * max_len) + 1, max_len)
+            #distance is symmetric, ordering the pair lets both orders share a memo entry
+            if search_word <= card_word:
+                key = (search_word, card_word, max_dist)
+            else:
+                key = (card_word, search_word, max_dist)
+            distance = distances.get(key)
+            if distance is None:
+                distance = distances[key] = _levenshtein_distance(*key)
+            if distance > max_dist:
+                return None
+            return 1 - (distance / max_len)
 
+        for card in self.cards:
             percent_match = 0.0
-
-            search_words = {}
-
-            for word in query.split(' '):
-                search_words.update({word : {}})
-
-            card_words = name.split(' ')
-
-            for search_word in search_words:
+            card_words = card['_name_words']
+            name_nospace_len = card['_name_nospace_len']
+            max_test_string_match = card['_name_longest_word_len'] / name_nospace_len
+
+            for i, search_word in enumerate(search_words):
+                #best case for the remaining words is a perfect match on the longest card word
+                max_remaining_match = remaining_string_matches[i] * .75 + max_test_string_match * .25 * (len(search_words) - i)
+                if percent_match + max_remaining_match < min_match:
+                    break
+
+                #keeps the first best card word, nothing beats a perfect match
+                match = -1.0
                 for card_word in card_words:
-                    match = 1 - (calc_levenshtein_distance(search_word, card_word) / max(len(search_word), len(card_word)))
-                    if search_word not in search_words.keys():
-                        search_words[search_word] = {card_word: { 'match' : match} }
-                    else:
-                        search_words[search_word].update( {card_word: { 'match' : match} } )
-
-            for search_word in search_words:
+                    card_word_match = word_match(search_word, card_word, match)
+                    if card_word_match is not None and card_word_match > match:
+                        match = card_word_match
+                        match_len = len(card_word)
+                        if match == 1.0:
+                            break
 
-                max_value_key = list(search_words[search_word].keys())[0]
-                max_value = search_words[search_word][max_value_key]
+                percent_test_string_match = match_len / name_nospace_len
+                percent_string_match = percent_string_matches[i]
 
-                for card_word in search_words[search_word]:
-                    if search_words[search_word][card_word]['match'] > max_value['match']:
-                        max_value_key = card_word
-                        max_value = search_words[search_word][card_word]
-
-                percent_test_string_match = len(max_value_key) / len(name.replace(" ", ""))
-                percent_string_match = len(search_word) / len(query.replace(" ", ""))
-
-                percent_match += percent_string_match * max_value['match'] * .75 + percent_test_string_match * max_value['match'] * .25
-
-            if percent_match >= min_match:
-                results.append([card, percent_match])
+                percent_match += percent_string_match * match * .75 + percent_test_string_match * match * .25
+            else:
+                if percent_match >= min_match:
+                    results.append([card, percent_match])
 
         if len(results) < 1:
             return
@@ -310,10 +399,10 @@ class Hearthstone():
                 current algorithm is to decide the card with the shortest card ID is the original
                 This exploits the naming scheme that typically has the main card follows the format EXP_123 and tokens look like EXP_123b
                 """
-                name = lst[0][0]['name']
+                name = lst[0][0]['_name_lower']
                 shortest = lst[0]
                 for card in lst:
-                    if card[0]['name'].lower() != name.lower(): continue
+                    if card[0]['_name_lower'] != name: continue
                     if len(card[0]['id']) < len(shortest[0]['id']):
                         shortest = card
 
@@ -323,7 +412,7 @@ class Hearthstone():
             #guarantees exact matches are always returned. Edge case: mortal coil and mortal strike
             exact_list = []
             for result in results:
-                if result[0]['name'].lower() == query: exact_list.append(result)
+                if result[0]['_name_lower'] == query: exact_list.append(result)
 
             #replaces results with a trimmed list of exact matches if any are found
             if exact_list: results = exact_list          
@@ -331,7 +420,10 @@ class Hearthstone():
             return detect_tokens(results)
 
     def discord_card_message(self, card):
-        """Formats a card into a string for a discord message"""
+        """Formats a card into a string for a discord message. The message is cached on the card"""
+
+        if '_discord_msg' in card:
+            return card['_discord_msg']
 
         name = card['name']
         type = card['type']
@@ -351,9 +443,10 @@ class Hearthstone():
         else:
             flavor = ""
         output = """[{name}]: {rarity}{type}{stats}{cost}{pclass}{race}{cset}\n{text}{flavor}"""
-        return output.format(name=name, rarity=rarity.title(), type=type.title(),
-                             stats=stats, cost=cost, pclass=pclass, race=race.title(), cset=cset,
-                             text=text, flavor=flavor)
+        card['_discord_msg'] = output.format(name=name, rarity=rarity.title(), type=type.title(),
+                                             stats=stats, cost=cost, pclass=pclass, race=race.title(), cset=cset,
+                                             text=text, flavor=flavor)
+        return card['_discord_msg']
 
     @commands.command()
     async def card(self, query : str):
@@ -369,8 +462,8 @@ class Hearthstone():
         else:
             await self.bot.say("Card not found.")
 
-    async def scan_card_queries(self, message, delimiters=['[',']']):
-        """on_message event that parses for queries within delimiters and display cards"""
+    async def scan_card_queries(self, message):
+        """on_message event that parses for queries within square brackets and display cards"""
 
         if message.author.id == self.bot.user.id:
             return
@@ -381,55 +474,20 @@ class Hearthstone():
         msg = message.content
         if '`' in msg: return
 
-        #adds all text contained in the delimiters to the queries list
-        queries = []
-        index = 0
-        msg_len = len(msg)
-        while index != -1:
-            index = msg.find(delimiters[0], index, msg_len)
-            close_index = msg.find(delimiters[1], index, msg_len)
-
-            if (index == -1 or close_index == -1):
-                break
-
-            queries.append(msg[index+1:close_index])
-            index = close_index + 1
-        output = ""
+        #adds all text contained in square brackets to the queries list
+        queries = _QUERY_RE.findall(msg)
+        messages = []
         for query in queries:
             card = await self._find_card(query, self.min_match)
 
             if card:
-                data = self.discord_card_message(card)
-                output = "{0}{1}\n\n".format(output, data)
+                messages.append(self.discord_card_message(card))
 
-        output = output[:-2] if output[-1:] == "\n" else output
+        output = "\n\n".join(messages)
 
         if len(output) > 0:
             await self.bot.send_message(message.channel, output)
 
-class CardType():
-    MINION = "MINION"
-    SPELL = "SPELL"
-    WEAPON = "WEAPON"
-
-class CardSet():
-    BASIC = "CORE"
-    BRM = "BRM"
-    CLASSIC = "EXPERT1"
-    CHEAT = "CHEAT"
-    CREDITS = "CREDITS"
-    GVG = "GVG"
-    HERO_SKINS = "HERO_SKINS"
-    KARA = "KARA"
-    LOE = "LOE"
-    MISSIONS = "MISSIONS"
-    NAXX = "NAXX"
-    NONE = "NONE"
-    PROMO = "PROMO"
-    REWARD = "REWARD"
-    TAVERNBRAWL = "TB"
-    TGT = "TGT"
-
 def setup(bot):
     hs = Hearthstone(bot)
     bot.add_cog(hs)
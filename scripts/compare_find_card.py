@@ -0,0 +1,150 @@
+"""Replays typo'd card name queries against the original card search and the current
+Hearthstone._find_card and prints every query where the two pick a different card.
+
+Usage: python scripts/compare_find_card.py [cards.json] [variants per card]
+
+Run from a checkout where the bot itself can be imported (discord.py installed, config.ini present).
+Exits with status 1 if any query differs.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from extensions.hearthstone import Hearthstone
+
+def baseline_find_card(cards, query, min_match):
+    """The card search as it was before any of the matching optimizations, kept as the reference"""
+
+    def calc_levenshtein_distance(s1, s2):
+        if len(s1) < len(s2):
+            return calc_levenshtein_distance(s2, s1)
+
+        # len(s1) >= len(s2)
+        if len(s2) == 0:
+            return len(s1)
+
+        previous_row = range(len(s2) + 1)
+        for i, c1 in enumerate(s1):
+            current_row = [i + 1]
+            for j, c2 in enumerate(s2):
+                insertions = previous_row[j + 1] + 1
+                deletions = current_row[j] + 1
+                substitutions = previous_row[j] + (c1 != c2)
+                current_row.append(min(insertions, deletions, substitutions))
+            previous_row = current_row
+
+        return previous_row[-1]
+
+    results = []
+    query = query.strip(' ').lower()
+    if len(query) < 1:
+        return
+    for card in cards:
+        name = card['name'].lower()
+
+        percent_match = 0.0
+
+        search_words = {}
+
+        for word in query.split(' '):
+            search_words.update({word : {}})
+
+        card_words = name.split(' ')
+
+        for search_word in search_words:
+            for card_word in card_words:
+                match = 1 - (calc_levenshtein_distance(search_word, card_word) / max(len(search_word), len(card_word)))
+                search_words[search_word].update({card_word: {'match' : match}})
+
+        for search_word in search_words:
+
+            max_value_key = list(search_words[search_word].keys())[0]
+            max_value = search_words[search_word][max_value_key]
+
+            for card_word in search_words[search_word]:
+                if search_words[search_word][card_word]['match'] > max_value['match']:
+                    max_value_key = card_word
+                    max_value = search_words[search_word][card_word]
+
+            percent_test_string_match = len(max_value_key) / len(name.replace(" ", ""))
+            percent_string_match = len(search_word) / len(query.replace(" ", ""))
+
+            percent_match += percent_string_match * max_value['match'] * .75 + percent_test_string_match * max_value['match'] * .25
+
+        if percent_match >= min_match:
+            results.append([card, percent_match])
+
+    if len(results) < 1:
+        return
+
+    results.sort(key=lambda r: r[1], reverse=True)
+
+    exact_list = [result for result in results if result[0]['name'].lower() == query]
+    if exact_list: results = exact_list
+
+    name = results[0][0]['name']
+    shortest = results[0]
+    for card in results:
+        if card[0]['name'].lower() != name.lower(): continue
+        if len(card[0]['id']) < len(shortest[0]['id']):
+            shortest = card
+    return shortest[0]
+
+def typo(name, rng):
+    """Returns name with one or two random character edits"""
+
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    name = name.lower()
+    for _ in range(rng.randint(1, 2)):
+        if len(name) < 2:
+            break
+        pos = rng.randrange(len(name))
+        edit = rng.choice(('substitute', 'delete', 'insert', 'transpose'))
+        if edit == 'substitute':
+            name = name[:pos] + rng.choice(letters) + name[pos+1:]
+        elif edit == 'delete':
+            name = name[:pos] + name[pos+1:]
+        elif edit == 'insert':
+            name = name[:pos] + rng.choice(letters) + name[pos:]
+        elif pos < len(name) - 1:
+            name = name[:pos] + name[pos+1] + name[pos] + name[pos+2:]
+    return name
+
+def main():
+    cards_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     os.pardir, "extensions", "hearthstone", "cards.json")
+    variants = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    with open(cards_path, 'r', encoding='utf8') as file:
+        cards = json.loads(file.read())
+
+    #skips Hearthstone.__init__ so no bot or network access is needed
+    hs = object.__new__(Hearthstone)
+    hs.min_match = 0.65
+    hs._clean_cards_dict(cards)
+    hs.cards = cards
+
+    rng = random.Random(0)
+    names = sorted({card['name'] for card in cards})
+    queries = [typo(name, rng) for name in names for _ in range(variants)]
+
+    loop = asyncio.get_event_loop()
+    differences = 0
+    for query in queries:
+        expected = baseline_find_card(cards, query, hs.min_match)
+        found = loop.run_until_complete(hs._find_card(query, hs.min_match))
+        expected_id = expected['id'] if expected else None
+        found_id = found['id'] if found else None
+        if expected_id != found_id:
+            differences += 1
+            print("{!r}: expected {} got {}".format(query, expected_id, found_id))
+
+    print("{} of {} queries differ".format(differences, len(queries)))
+    sys.exit(1 if differences else 0)
+
+if __name__ == '__main__':
+    main()